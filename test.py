@@ -52,4 +52,40 @@ from pprint import pprint
 pprint(object_log)
 
 
+### boxes admitted in the same frame get distinct ids
+tracker = tracking.ObjectTracker()
+tracker.process_new_frame({"windows": "100,100,200,200,562,99,883,420,1,11,271,219", "date_created": 1532538996.0, "no_faces": 3})
+ids = [obj.id for obj in tracker.active[0].objects]
+assert len(set(ids)) == 3, ids
+
+
+### compiled and NumPy matching kernels give the same pairs
+import numpy as np
+rng = np.random.default_rng(0)
+for _ in range(300):
+    nA, nB = rng.integers(0, 8, 2)
+    corners = rng.integers(0, 60, (nA + nB, 2))
+    coords = np.hstack([corners, corners + rng.integers(5, 40, (nA + nB, 2))]).astype(np.int32)
+    areas = (coords[:,2] - coords[:,0] + 1) * (coords[:,3] - coords[:,1] + 1)
+    speeds = rng.uniform(0, 5, nA + nB)
+    speeds[rng.random(nA + nB) < 0.3] = np.nan
+    for use_momentum in (True, False):
+        args = (coords[:nA], areas[:nA], speeds[:nA], coords[nA:], areas[nA:], speeds[nA:], 0.3, 0.5, use_momentum)
+        expected = tracking._match_numpy(*args)
+        assert np.array_equal(tracking._match_loops(*args), expected), args
+        assert np.array_equal(tracking._match(*args), expected), args
+
+
+### frames retire past max_frames, logging objects that left the view before close
+tracker = tracking.ObjectTracker()
+tracker.max_frames = 2
+frames  = [{"windows": "348,241,669,562", "date_created": 1533227749.0 + t, "no_faces": 1} for t in range(3)]
+frames += [{"windows": "974,290,1359,675", "date_created": 1533227752.0 + t, "no_faces": 1} for t in range(4)]
+for frame in frames:
+    tracker.process_new_frame(frame)
+    assert len(tracker.active) <= tracker.max_frames, len(tracker.active)
+assert [obj.coords for obj in tracker.object_log] == [(348,241,669,562)], tracker.object_log
+assert tracker.object_log[0].time_alive == 2, tracker.object_log
+
+
 
@@ -16,14 +16,23 @@
 
 import time as _time
 from datetime import datetime as _datetime
-import math as _math
+
+from collections import deque as _deque
+from functools import lru_cache as _lru_cache
+
+import numpy as _np
+
+try:
+    from numba import njit as _njit
+except ImportError:
+    _njit = None
 
 class ObjectTracker:
     """ Manages identification and tracking of objects
         from a single view across multiple frames over time. """
     
     def __init__(self):
-        self.active = []
+        self.active = _deque()
         self.object_log = []
 
         ### Object matching parameters
@@ -40,43 +49,40 @@ class ObjectTracker:
         ### Minimum lifetime required for output logging
         self.min_seconds = 1
 
+        ### Count of active objects carrying each id, maintained on admit, merge and log-out
+        self._id_refs = _np.zeros(900,dtype=_np.int32)
+
     def get_id(self):
-        taken = set([obj.id for frame in self.active for obj in frame.objects if obj.id is not None])
-        #print("taken ids: {}".format(','.join([str(name) for name in taken])))   
-        for i in range(100,1000,100):
-            #print("checking ids from {} to {}".format(i-100,i))
-            new = set(range(i-100,i))
-            free = list(new-taken)
-            if len(free) > 0:
-                return free[0]
-            
+        """ lowest id not carried by any object in the active frames """
+        oid = int(_np.argmin(self._id_refs))
+        if self._id_refs[oid]:
+            oid = len(self._id_refs)
+            self._id_refs = _np.concatenate([self._id_refs,_np.zeros_like(self._id_refs)])
+        self._id_refs[oid] += 1
+        return oid
+
     def momentum_match(self,objA,objB):
         """ Given two TrackedObjects, return Boolean match based on movement.
-            Default of lack of data is no match. """
+            Default of lack of data is no match.
+            Scalar form of the test _match applies to whole frames; not used by the tracker itself. """
         if not (objA.speed and objB.speed):
             return False
         return abs( objA.speed - objB.speed ) < self.momentum_scale            
 
     def location_match(self,objA,objB):
         """ Given two TrackedObjects, return Boolean match based on location.
-            Default of lack of data is no match. """
-        boxA = objA.coords
-        boxB = objB.coords
-        try:
-            xA = max(boxA[0], boxB[0])
-            yA = max(boxA[1], boxB[1])
-            xB = min(boxA[2], boxB[2])
-            yB = min(boxA[3], boxB[3])
-            
-            interArea = max(0,xB-xA+1) * max(0,yB-yA+1)
-            boxAArea = (boxA[2] - boxA[0] + 1) * (boxA[3] - boxA[1] + 1)
-            boxBArea = (boxB[2] - boxB[0] + 1) * (boxB[3] - boxB[1] + 1)
-            iou = interArea / float(boxAArea + boxBArea - interArea)
-            if iou>self.iou_threshold:
-                return True
-        except:
-            pass
-        return 0
+            Default of lack of data is no match.
+            Scalar form of the test _match applies to whole frames; not used by the tracker itself. """
+        a0,a1,a2,a3 = objA.coords
+        b0,b1,b2,b3 = objB.coords
+        # most pairs are separated on some axis; x first since views are wide
+        if a2 < b0 or b2 < a0 or a3 < b1 or b3 < a1:
+            return False
+        # past the check above the boxes overlap on both axes
+        interArea = ((a2 if a2 < b2 else b2) - (a0 if a0 > b0 else b0) + 1) \
+                  * ((a3 if a3 < b3 else b3) - (a1 if a1 > b1 else b1) + 1)
+        # iou > threshold, without the division
+        return interArea > self.iou_threshold * (objA._area + objB._area - interArea)
 
 
     def frame_update(self,frameA,frameB):
@@ -84,21 +90,34 @@ class ObjectTracker:
         #print("comparing {} new objects with {} old objects".format(len(frameB.new_objects),len(frameA.objects)))
         no_matches = []
         
-        # First pass using momentum factors
-        for obja in frameA.objects:
-            for objb in frameB.new_objects:
-                if self.momentum_match(obja,objb):
-                    objb.observe(obja)
-        
-        # Second pass using location
-        for obja in frameA.objects:
-            for objb in frameB.new_objects:
-                if self.location_match(obja,objb):
-                    objb.observe(obja)
+        new_idx = _np.flatnonzero(frameB.new_mask)
+        if not len(new_idx):
+            return frameB
+        new_speeds = frameB.speeds_arr[new_idx]
+        # momentum needs a speed on both sides, and only frameB's new objects are compared
+        use_momentum = frameA.has_speed and bool(_np.isfinite(new_speeds).any())
+        pairs = _match(frameA.coords_arr, frameA.areas_arr, frameA.speeds_arr,
+                       frameB.coords_arr[new_idx], frameB.areas_arr[new_idx], new_speeds,
+                       self.iou_threshold, self.momentum_scale,
+                       use_momentum)
+        for i,j in pairs:
+            if frameB.new_mask[new_idx[j]]:
+                self._merge(frameA,i,frameB,new_idx[j])
         
         return frameB
 
 
+    def _merge(self,frameA,i,frameB,j):
+        """ merge object j of frameB with object i of frameA, keeping both frames' arrays current """
+        old_ids = frameA.ids_arr[i], frameB.ids_arr[j]
+        frameB.objects[j].observe(frameA.objects[i])
+        frameA.sync(i)
+        frameB.sync(j)
+        for old,new in zip(old_ids,(frameA.ids_arr[i],frameB.ids_arr[j])):
+            if old != new:
+                self._id_refs[old] -= 1
+                self._id_refs[new] += 1
+
     def process_new_frame(self,new_frame):
         """ new_frame must have 0 or more boxes in it.
             Update active frames and list of objects present in new frame. """
@@ -114,11 +133,8 @@ class ObjectTracker:
 
         self.active.append(new_frame)
 
-        if len(self.active) > self.max_frames:
-            retiring = self.active[:-(self.max_frames+1)]
-            self.active = self.active[-(self.max_frames+1):]
-            for frame in retiring:
-                self.log_objects(frame)
+        while len(self.active) > self.max_frames:
+            self.log_objects(self.active.popleft())
 
     def close(self):
         """ close out active frames and log their objects """
@@ -129,42 +145,120 @@ class ObjectTracker:
 
     def log_objects(self,frame):
         """ log objects which are not present in active frames """
-        obj_ids = [obj.id for obj in frame.objects]
-        exc_ids = [obj.id for _frame in self.active for obj in _frame.objects]
-        new_object_ids = list(set(obj_ids) - set(exc_ids))
+        _np.subtract.at(self._id_refs,frame.ids_arr,1)
 
         for obj in frame.objects:
-            if obj.id in new_object_ids and obj.time_alive >= self.min_seconds:
+            if not self._id_refs[obj.id] and obj.time_alive >= self.min_seconds:
                 self.object_log.append(obj)
 
                 
+def _iou_match_matrix(coordsA,areasA,coordsB,areasB,iou_threshold):
+    """ whether IoU exceeds iou_threshold for every box in coordsA (N,4) against every box in coordsB (M,4),
+        as an (N,M) boolean array. same test as location_match: inter > threshold * union """
+    tl = _np.maximum(coordsA[:,None,:2], coordsB[None,:,:2])
+    br = _np.minimum(coordsA[:,None,2:], coordsB[None,:,2:])
+    wh = _np.clip(br - tl + 1, 0, None)
+    inter = wh[...,0] * wh[...,1]
+    return inter > iou_threshold * (areasA[:,None] + areasB[None,:] - inter)
+
+def _match_numpy(coordsA,areasA,speedsA,coordsB,areasB,speedsB,iou_threshold,momentum_scale,use_momentum):
+    """ (i,j) pairs of boxes in A matching boxes in B, in the order they should be merged.
+        A pair matches on momentum or on location, in a single scan in (i,j) order;
+        each j is matched at most once, to the first i that matches it.
+        Speeds are taken as they stand before any of the merges. """
+    match = _iou_match_matrix(coordsA,areasA,coordsB,areasB,iou_threshold)
+    if use_momentum:
+        # NaN speeds (no data) never compare below the scale
+        with _np.errstate(invalid='ignore'):
+            match |= _np.abs(speedsA[:,None] - speedsB[None,:]) < momentum_scale
+
+    matched = _np.zeros(len(coordsB),dtype=bool)
+    pairs = []
+    for i,j in _np.argwhere(match):
+        if not matched[j]:
+            pairs.append((i,j))
+            matched[j] = True
+            if len(pairs) == len(coordsB):
+                break
+
+    return _np.array(pairs,dtype=_np.int64).reshape(-1,2)
+
+def _match_loops(coordsA,areasA,speedsA,coordsB,areasB,speedsB,iou_threshold,momentum_scale,use_momentum):
+    """ same as _match_numpy, written as plain loops for compilation with numba """
+    nA = coordsA.shape[0]
+    nB = coordsB.shape[0]
+    matched = _np.zeros(nB,dtype=_np.bool_)
+    pairs = _np.empty((nB,2),dtype=_np.int64)
+    n = 0
+
+    for i in range(nA):
+        a0,a1,a2,a3 = coordsA[i,0],coordsA[i,1],coordsA[i,2],coordsA[i,3]
+        areaA = areasA[i]
+        speedA = speedsA[i]
+        for j in range(nB):
+            if matched[j]:
+                continue
+            hit = use_momentum and abs(speedA - speedsB[j]) < momentum_scale
+            if not hit:
+                # most pairs are separated on some axis; x first since views are wide
+                w = min(a2,coordsB[j,2]) - max(a0,coordsB[j,0]) + 1
+                if w <= 0:
+                    continue
+                h = min(a3,coordsB[j,3]) - max(a1,coordsB[j,1]) + 1
+                if h <= 0:
+                    continue
+                inter = w * h
+                hit = inter > iou_threshold * (areaA + areasB[j] - inter)
+            if hit:
+                pairs[n,0] = i
+                pairs[n,1] = j
+                n += 1
+                matched[j] = True
+                if n == nB:
+                    return pairs[:n]
+
+    return pairs[:n]
+
+_match = _njit(cache=True)(_match_loops) if _njit is not None else _match_numpy
+
 class _Frame:
-    objects = None
+    __slots__ = ('timestamp','face_count','objects','new_objects',
+                 'coords_arr','areas_arr','ids_arr','speeds_arr','new_mask')
 
     @property
-    def new_objects(self):
-        return [obj for obj in self.objects if obj.new_observation]    
+    def has_speed(self):
+        """ whether any object has been observed more than once, i.e. has a speed """
+        return bool(_np.isfinite(self.speeds_arr).any())
 
     def __init__(self,frame_dict,tracker):
         self.timestamp = float(frame_dict['date_created'])
         self.face_count = int(frame_dict['no_faces'])
-        self.objects = [TrackedObject(bbox,self.timestamp,tracker.get_id()) for bbox in self._convert_to_frame_of_boxes(frame_dict['windows']) ]
+        self.coords_arr = self._convert_to_frame_of_boxes(frame_dict['windows'])
+        self.objects = [TrackedObject(bbox,self.timestamp,tracker.get_id()) for bbox in self.coords_arr.tolist()]
+        self.areas_arr = _np.array([obj._area for obj in self.objects],dtype=_np.int64)
+        # per-object state as arrays; speeds of NaN mean no data (a single observation)
+        self.ids_arr = _np.array([obj.id for obj in self.objects],dtype=_np.int64)
+        self.speeds_arr = _np.full(len(self.objects),_np.nan,dtype=_np.float64)
+        self.new_mask = _np.ones(len(self.objects),dtype=bool)
+        self.new_objects = list(self.objects)
+
+    def sync(self,index):
+        """ refresh the array state of one object after it has been merged """
+        obj = self.objects[index]
+        self.ids_arr[index] = obj.id
+        self.speeds_arr[index] = obj.speed or _np.nan
+        if self.new_mask[index] and not obj.new_observation:
+            self.new_objects.remove(obj)
+        self.new_mask[index] = obj.new_observation
 
     def _convert_to_frame_of_boxes(self,array):
-        """ for any-lenth array or list, give a list of tuples where each tuple is length 4"""
-        #print("   input array {}".format(array))
+        """ for any-length comma separated string or list, give an (N,4) int32 array of boxes.
+            trailing values short of a full box are dropped. """
         if type(array) == str:
-            array = array.split(',')
-        if len(array) <4:
-            return []
-        output = []
-        unfinished = []
-        for item in array:
-            unfinished.append(int(item))
-            if len(unfinished) == 4:
-                output.append(unfinished)
-                unfinished = []
-        return output
+            array = _np.fromstring(array,sep=',',dtype=_np.int32)
+        else:
+            array = _np.asarray(array,dtype=_np.int32).ravel()
+        return array[:array.size - array.size % 4].reshape(-1,4)
 
     def __repr__(self):
         report = "frame with {} objects".format(len(self.objects))
@@ -172,49 +266,32 @@ class _Frame:
             report += "\n    "+str(obj)
         return report
 
-class _Footprint:
-    @property
-    def isotimestamp(self):
-        return _datetime.utcfromtimestamp(self.timestamp).isoformat()
-    
-    def __init__(self,coords,timestamp):
-        self.coords=coords
-        self.timestamp=timestamp
-        
-    def __lt__(self,other):
-        return self.timestamp < other.timestamp
-    
-    def __gt__(self,other):
-        return self.timestamp > other.timestamp
-    
-    def __eq__(self,other):
-        return self.timestamp == other.timestamp and self.coords == other.coords
-    
-    def __ne__(self,other):
-        return self.timestamp != other.timestamp or self.coords != other.coords
-        
-    def __le__(self,other):
-        return self.timestamp <= other.timestamp
-    
-    def __ge__(self,other):
-        return self.timestamp >= other.timestamp
-        
-    def __cmp__(self,other):
-        return self.timestamp.__cmp__(other)
-    
-    def __repr__(self):
-        return f"{self.isotimestamp}" + " (" + ','.join([str(x) for x in self.coords]) + ")"
+@_lru_cache(maxsize=1024)
+def _isotimestamp(timestamp):
+    """ ISO format of a timestamp; cached since merged objects share most of their footprints """
+    return _datetime.utcfromtimestamp(timestamp).isoformat()
+
+def _format_footprint(footprint):
+    """ display a (timestamp, coords) footprint """
+    timestamp,coords = footprint
+    return _isotimestamp(timestamp) + " (" + ','.join([str(x) for x in coords]) + ")"
 
 class TrackedObject:
     """ Class represents an object/face located in a Frame """
+    __slots__ = ('coords','_area','id','new_observation','tracks','_speed_cache')
     
     @property
     def date_created(self):
-        return self.tracks[0].timestamp
+        return float(self.tracks[0,0])
     
     @property
     def end_time(self):
-        return self.tracks[-1].timestamp
+        return float(self.tracks[-1,0])
+
+    @property
+    def footprints(self):
+        """ track history as a list of (timestamp, coords) tuples """
+        return [(float(row[0]),tuple(int(x) for x in row[1:])) for row in self.tracks]
     
     @property
     def time_alive(self):
@@ -222,6 +299,11 @@ class TrackedObject:
 
     @property
     def speed(self):
+        if self._speed_cache is None:
+            self._speed_cache = self._compute_speed()
+        return self._speed_cache
+
+    def _compute_speed(self):
         def centroid(coords):
             y1,x1,y2,x2 = coords
             return (y1+(y2-y1)/2 , x1+(x2-x1)/2)
@@ -231,19 +313,22 @@ class TrackedObject:
         if not self.coords:
             return None
         else:
-            start = self.tracks[0].coords
-            end = self.tracks[-1].coords
-            
-            t0 = self.tracks[0].timestamp
-            t1 = self.tracks[-1].timestamp
+            t0,x0,y0 = self.tracks[0,:3]
+            t1,x1,y1 = self.tracks[-1,:3]
             
-            return _math.sqrt( (end[0]-start[0])**2 + (end[1]-start[1])**2 ) / (t1-t0)
+            return float(_np.hypot(x1-x0,y1-y0) / (t1-t0))
 
     def __init__(self,coords,date_created,oid):
+        coords = tuple(coords)
+        if len(coords) != 4 or not all(isinstance(x,int) for x in coords):
+            raise ValueError("coords must be 4 integers, got {}".format(coords))
         self.coords = coords
+        self._area = (coords[2] - coords[0] + 1) * (coords[3] - coords[1] + 1)
         self.id = oid
         self.new_observation = True
-        self.tracks = [_Footprint(coords,date_created)]
+        # rows of [timestamp, x0, y0, x1, y1], in time order
+        self.tracks = _np.array([(date_created,) + coords],dtype=_np.float64)
+        self._speed_cache = None
         
 
     def observe(self,other_obj):
@@ -260,15 +345,18 @@ class TrackedObject:
             other_obj.new_observation = False
             other_obj.id = self.id
             
-        tracks = other_obj.tracks + self.tracks
-        tracks.sort()
+        # both histories are already in time order; usually other_obj's is entirely older
+        tracks = _np.concatenate((other_obj.tracks,self.tracks))
+        if other_obj.tracks[-1,0] > self.tracks[0,0]:
+            tracks = tracks[_np.argsort(tracks[:,0],kind='stable')]
         self.tracks = other_obj.tracks = tracks
+        self._speed_cache = other_obj._speed_cache = None
 
             
     def __repr__(self):
         report = "id: {} - coords: {}".format(self.id,','.join([str(x) for x in self.coords]))
         report += "\n  lived {} secs ({} to {})".format(self.time_alive,self.date_created,self.end_time)
-        report += "\n  tracks: {}".format(self.tracks)
+        report += "\n  tracks: [{}]".format(', '.join([_format_footprint(f) for f in self.footprints]))
         report += "\n"
         return report
 
@@ -283,8 +371,10 @@ class TrackedObject:
 def track_objects(json_data):
     tracker = ObjectTracker()
 
+    # frames without any boxes change nothing, skip them before they reach the tracker
     for frame in json_data:
-        tracker.process_new_frame(frame)
+        if frame.get("no_faces") != 0:
+            tracker.process_new_frame(frame)
 
     tracker.close()
 